@@ -22,12 +22,241 @@
 
 from base import *
 import datetime
-import time
 from scalar import ScalarEncoder
 import numpy
 
 from nupic.data import SENTINEL_VALUE_FOR_MISSING_DATA
 
+# Maps the day names accepted by the customDays parameter to the day of week
+#  (monday = 0), as returned by datetime.datetime.weekday()
+_DAY_MAP = {"mon": 0, "monday": 0,
+            "tue": 1, "tuesday": 1,
+            "wed": 2, "wednesday": 2,
+            "thu": 3, "thursday": 3,
+            "fri": 4, "friday": 4,
+            "sat": 5, "saturday": 5,
+            "sun": 6, "sunday": 6}
+
+# Unix epoch, for timestamps datetime.datetime.utcfromtimestamp() can't convert
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+############################################################################
+# Scalar extractors. DateEncoder.__init__ builds a list of these, one per
+#  active sub-encoder and in the same order as DateEncoder.encoders, so that
+#  getEncodedValues() doesn't re-test which sub-encoders are present on every
+#  call. They are module level functions taking the encoder as first argument
+#  (rather than closures or bound methods) so that encoders stay picklable.
+
+def _getSeasonValue(encoder, input):
+  jan1 = encoder._jan1Cache.get(input.year)
+  if jan1 is None:
+    jan1 = datetime.datetime(input.year, 1, 1)
+    encoder._jan1Cache[input.year] = jan1
+
+  # Number of whole days since January 1st, i.e. the 0 based day of year
+  return (input - jan1).days
+
+
+def _getDayOfWeekValue(encoder, input):
+  return input.weekday()
+
+
+def _getWeekendValue(encoder, input):
+  # saturday, sunday or friday evening
+  dayOfWeek = input.weekday()
+  if dayOfWeek == 6 or dayOfWeek == 5 \
+      or (dayOfWeek == 4 and input.hour + input.minute / 60.0 > 18):
+    return 1
+  else:
+    return 0
+
+
+def _getCustomDayValue(encoder, input):
+  # Bit test on the custom days mask instead of a set lookup
+  return (encoder._customDaysMask >> input.weekday()) & 1
+
+
+def _getHolidayDates(encoder, year):
+  hdates = encoder._holidayCache.get(year)
+  if hdates is None:
+    # hdate is midnight on the holiday
+    hdates = tuple(datetime.datetime(year, month, day)
+                   for (month, day) in encoder._holidays)
+    encoder._holidayCache[year] = hdates
+  return hdates
+
+
+def _getHolidayValue(encoder, input):
+  # A "continuous" binary value. = 1 on the holiday itself and smooth ramp
+  #  0->1 on the day before the holiday and 1->0 on the day after the holiday.
+  val = 0
+  for hdate in _getHolidayDates(encoder, input.year):
+    diff = input - hdate
+    if diff.days == 0:
+      if not diff:
+        # exactly midnight on the holiday, the end of the 0 -> 1 ramp
+        val = 1.0
+        continue
+      # return 1 on the holiday itself
+      val = 1
+      break
+    elif diff.days == 1:
+      # ramp smoothly from 1 -> 0 on the next day
+      val = 1.0 - diff.seconds / 86400.0
+      break
+    elif diff.days == -1:
+      diff = -diff
+      if diff.days == 0:
+        # ramp smoothly from 0 -> 1 on the previous day
+        val = 1.0 - diff.seconds / 86400.0
+
+  return val
+
+
+def _getSingleHolidayValue(encoder, input):
+  # _getHolidayValue() without the loop, for encoders with a single holiday
+  hdates = encoder._holidayCache.get(input.year)
+  if hdates is None:
+    hdates = _getHolidayDates(encoder, input.year)
+
+  diff = input - hdates[0]
+  days = diff.days
+  if days == 0:
+    if not diff:
+      # exactly midnight on the holiday, the end of the 0 -> 1 ramp
+      return 1.0
+    # return 1 on the holiday itself
+    return 1
+  elif days == 1:
+    # ramp smoothly from 1 -> 0 on the next day
+    return 1.0 - diff.seconds / 86400.0
+  elif days == -1:
+    diff = -diff
+    if diff.days == 0:
+      # ramp smoothly from 0 -> 1 on the previous day
+      return 1.0 - diff.seconds / 86400.0
+  return 0
+
+
+def _getTimeOfDayValue(encoder, input):
+  return input.hour + input.minute / 60.0
+
+
+# Sub-encoders of a DateEncoder, in the order they appear in its output:
+#  (constructor parameter, description, minval, maxval, periodic,
+#   default radius, scalar extractor)
+_SUB_ENCODER_SPECS = (
+  # Ignore leapyear differences -- assume 366 days in a year
+  # Radius = 91.5 days = length of season
+  # Value is number of days since beginning of year (0 - 365)
+  ("season", "season", 0, 366, True, 91.5, _getSeasonValue),
+  # Value is day of week (floating point)
+  # Radius is 1 day
+  ("dayOfWeek", "day of week", 0, 7, True, 1, _getDayOfWeekValue),
+  # Binary value. Not sure if this makes sense. Also is somewhat redundant
+  #  with dayOfWeek
+  ("weekend", "weekend", 0, 1, False, 1, _getWeekendValue),
+  # Binary value, 1 on the days listed in the customDays parameter
+  ("customDays", "customdays", 0, 1, False, 1, _getCustomDayValue),
+  # A "continuous" binary value. = 1 on the holiday itself and smooth ramp
+  #  0->1 on the day before the holiday and 1->0 on the day after the holiday.
+  ("holiday", "holiday", 0, 1, False, 1, _getHolidayValue),
+  # Value is time of day in hours
+  # Radius = 4 hours, e.g. morning, afternoon, evening, early night,
+  #  late night, etc.
+  ("timeOfDay", "time of day", 0, 24, True, 4, _getTimeOfDayValue),
+)
+
+
+# Field codes understood by _fillBatchScalars(), one per extractor
+(_SEASON, _DAY_OF_WEEK, _WEEKEND, _CUSTOM_DAY, _HOLIDAY, _TIME_OF_DAY) = range(6)
+_FIELD_CODES = {_getSeasonValue: _SEASON,
+                _getDayOfWeekValue: _DAY_OF_WEEK,
+                _getWeekendValue: _WEEKEND,
+                _getCustomDayValue: _CUSTOM_DAY,
+                _getHolidayValue: _HOLIDAY,
+                _getSingleHolidayValue: _HOLIDAY,
+                _getTimeOfDayValue: _TIME_OF_DAY}
+
+
+############################################################################
+def _fillBatchScalars(days, yearDays, micros, holidayDays, customDaysMask,
+                      fields, out):
+  """ Fill out[i, j] with scalar fields[j] of record i.
+
+  Computes the same values as the scalar extractors above, from integer
+  columns instead of datetime objects, so that it can be compiled by numba.
+
+  days:           days since 1970-01-01 of each record
+  yearDays:       days since 1970-01-01 of January 1st of each record's year
+  micros:         microseconds since midnight of each record
+  holidayDays:    (nRecords, nHolidays) days since 1970-01-01 of each holiday
+                  in the record's year
+  customDaysMask: bit d is set if day of week d is one of the custom days
+  fields:         field code (_SEASON, _DAY_OF_WEEK, ...) of each column of out
+  """
+  for i in range(out.shape[0]):
+    # 1970-01-01 was a Thursday (Monday = 0)
+    dayOfWeek = (days[i] + 3) % 7
+    minutes = micros[i] // 60000000
+    timeOfDay = minutes // 60 + (minutes % 60) / 60.0
+
+    for j in range(fields.shape[0]):
+      field = fields[j]
+      if field == _SEASON:
+        out[i, j] = days[i] - yearDays[i]
+      elif field == _DAY_OF_WEEK:
+        out[i, j] = dayOfWeek
+      elif field == _WEEKEND:
+        # saturday, sunday or friday evening
+        if dayOfWeek >= 5 or (dayOfWeek == 4 and timeOfDay > 18):
+          out[i, j] = 1.0
+        else:
+          out[i, j] = 0.0
+      elif field == _CUSTOM_DAY:
+        out[i, j] = (customDaysMask >> dayOfWeek) & 1
+      elif field == _HOLIDAY:
+        # Same ramp as _getHolidayValue(), in whole seconds
+        val = 0.0
+        for k in range(holidayDays.shape[1]):
+          delta = days[i] - holidayDays[i, k]
+          if delta == 0:
+            val = 1.0
+            break
+          elif delta == 1:
+            val = 1.0 - (micros[i] // 1000000) / 86400.0
+            break
+          elif delta == -1 and micros[i] > 0:
+            val = 1.0 - ((86400000000 - micros[i]) // 1000000) / 86400.0
+        out[i, j] = val
+      else:
+        out[i, j] = timeOfDay
+
+
+# numba is optional. When it is available the batch encoding path runs
+#  _fillBatchScalars() compiled by numba, otherwise it uses numpy ufuncs.
+#  numba is slow to import and only the batch path needs it, so it isn't
+#  imported until the first batch is encoded.
+_batchKernel = None
+_batchKernelLoaded = False
+
+
+def _getBatchKernel():
+  """ Return the numba compiled _fillBatchScalars(), or None if numba isn't
+  installed """
+  global _batchKernel, _batchKernelLoaded
+  if not _batchKernelLoaded:
+    _batchKernelLoaded = True
+    try:
+      import numba
+    except ImportError:
+      pass
+    else:
+      _batchKernel = numba.njit(cache=True)(_fillBatchScalars)
+  return _batchKernel
+
+
 ############################################################################
 class DateEncoder(Encoder):
   """A date encoder encodes a date according to encoding parameters
@@ -64,6 +293,19 @@ class DateEncoder(Encoder):
 
 
   """
+
+  __VERSION__ = 1
+
+  ############################################################################
+  def __new__(cls, season=0, dayOfWeek=0, weekend=0, holiday=0, timeOfDay=0,
+              customDays=0, name=''):
+    # Most models use exactly the season, dayOfWeek, weekend and timeOfDay
+    #  sub-encoders; use the subclass specialized for that configuration
+    if cls is DateEncoder and season != 0 and dayOfWeek != 0 and weekend != 0 \
+        and timeOfDay != 0 and holiday == 0 and customDays == 0:
+      cls = _DateEncoderSDWT
+    return super(DateEncoder, cls).__new__(cls)
+
   ############################################################################
   def __init__(self, season=0, dayOfWeek=0, weekend=0, holiday=0, timeOfDay=0, customDays=0,
                 name = ''):
@@ -71,69 +313,35 @@ class DateEncoder(Encoder):
     self.width = 0
     self.description = []
     self.name = name
+    self._version = DateEncoder.__VERSION__
 
     # This will contain a list of (name, encoder, offset) tuples for use by
     #  the decode() method
     self.encoders = []
 
-    self.seasonEncoder = None
-    if season != 0:
-      # Ignore leapyear differences -- assume 366 days in a year
-      # Radius = 91.5 days = length of season
-      # Value is number of days since beginning of year (0 - 355)
-      if hasattr(season, "__getitem__"):
-        w = season[0]
-        radius = season[1]
-      else:
-        w = season
-        radius = 91.5
-
-      self.seasonEncoder = ScalarEncoder(w = w, minval=0, maxval=366,
-                                         radius=radius, periodic=True,
-                                         name="season")
-      self.seasonOffset = self.width
-      self.width += self.seasonEncoder.getWidth()
-      self.description.append(("season", self.seasonOffset))
-      self.encoders.append(("season", self.seasonEncoder, self.seasonOffset))
-
-
-    self.dayOfWeekEncoder = None
-    if dayOfWeek != 0:
-      # Value is day of week (floating point)
-      # Radius is 1 day
-      if hasattr(dayOfWeek, "__getitem__"):
-        w = dayOfWeek[0]
-        radius = dayOfWeek[1]
-      else:
-        w = dayOfWeek
-        radius = 1
-      self.dayOfWeekEncoder = ScalarEncoder(w = w, minval=0, maxval=7,
-                                            radius=radius, periodic=True,
-                                            name="day of week")
-      self.dayOfWeekOffset = self.width
-      self.width += self.dayOfWeekEncoder.getWidth()
-      self.description.append(("day of week", self.dayOfWeekOffset))
-      self.encoders.append(("day of week", self.dayOfWeekEncoder, self.dayOfWeekOffset))
-
-    self.weekendEncoder = None
-    if weekend != 0:
-      # Binary value. Not sure if this makes sense. Also is somewhat redundant
-      #  with dayOfWeek
-      #Append radius if it was not provided
-      if not hasattr(weekend, "__getitem__"):
-        weekend = (weekend,1)
-      self.weekendEncoder = ScalarEncoder(w = weekend[0], minval = 0, maxval=1,
-                                          periodic=False, radius=weekend[1],
-                                          name="weekend")
-      self.weekendOffset = self.width
-      self.width += self.weekendEncoder.getWidth()
-      self.description.append(("weekend", self.weekendOffset))
-      self.encoders.append(("weekend", self.weekendEncoder, self.weekendOffset))
+    # The matching list of scalar extractor functions for each sub-encoder
+    self._extractors = []
+
+    # The sub-encoders and their offsets from self.encoders as separate lists,
+    #  so the per-record loops don't have to unpack a tuple per sub-encoder
+    self._subEncoders = []
+    self._subEncoderOffsets = []
+
+    # Currently the only holiday we know about is December 25
+    # holidays is a tuple of (month, day) holidays that occur on a fixed
+    #  date every year
+    self._holidays = ((12, 25),)
+    # Maps year -> tuple of datetimes at midnight on each holiday in that year
+    self._holidayCache = {}
+    # Maps year -> datetime at midnight on January 1st of that year
+    self._jan1Cache = {}
 
     #Set up custom days encoder, first argument in tuple is width
     #second is either a single day of the week or a list of the days
     #you want encoded as ones.
-    self.customDaysEncoder = None
+    customDayEncoderName = None
+    # Bit d is set if day of week d is one of the custom days
+    self._customDaysMask = 0
     if customDays !=0:
       customDayEncoderName = ""
       daysToParse = []
@@ -148,61 +356,113 @@ class DateEncoder(Encoder):
       else:
         assert False, "You must provide either a list of days or a single day"
       #Parse days
-      self.customDays = []
+      days = []
       for day in daysToParse:
-        if(day.lower() in ["mon","monday"]):
-          self.customDays+=[0]
-        elif day.lower() in ["tue","tuesday"]:
-          self.customDays+=[1]
-        elif day.lower() in ["wed","wednesday"]:
-          self.customDays+=[2]
-        elif day.lower() in ["thu","thursday"]:
-          self.customDays+=[3]
-        elif day.lower() in ["fri","friday"]:
-          self.customDays+=[4]
-        elif day.lower() in ["sat","saturday"]:
-          self.customDays+=[5]
-        elif day.lower() in ["sun","sunday"]:
-          self.customDays+=[6]
-        else:
-          assert False, "Unable to understand %s as a day of week" % str(day)
-      self.customDaysEncoder = ScalarEncoder(w=customDays[0], minval = 0, maxval=1,
-                                            periodic=False, radius=1,
-                                            name=customDayEncoderName)
-      self.customDaysOffset = self.width
-      self.width += self.customDaysEncoder.getWidth()
-      self.description.append(("customdays", self.customDaysOffset))
-      self.encoders.append(("customdays", self.customDaysEncoder, self.customDaysOffset))
-
-    self.holidayEncoder = None
-    if holiday != 0:
-      # A "continuous" binary value. = 1 on the holiday itself and smooth ramp
-      #  0->1 on the day before the holiday and 1->0 on the day after the holiday.
-      self.holidayEncoder = ScalarEncoder(w = holiday, minval = 0, maxval=1,
-                                          periodic=False, radius=1,
-                                          name="holiday")
-      self.holidayOffset = self.width
-      self.width += self.holidayEncoder.getWidth()
-      self.description.append(("holiday", self.holidayOffset))
-      self.encoders.append(("holiday", self.holidayEncoder, self.holidayOffset))
-
-    self.timeOfDayEncoder = None
-    if timeOfDay != 0:
-      # Value is time of day in hours
-      # Radius = 4 hours, e.g. morning, afternoon, evening, early night,
-      #  late night, etc.
-      if hasattr(timeOfDay, "__getitem__"):
-        w = timeOfDay[0]
-        radius = timeOfDay[1]
+        weekday = _DAY_MAP.get(day.lower())
+        assert weekday is not None, \
+               "Unable to understand %s as a day of week" % str(day)
+        days.append(weekday)
+      self.customDays = frozenset(days)
+      for weekday in days:
+        self._customDaysMask |= 1 << weekday
+      # Only the width is left to set up the sub-encoder itself
+      customDays = customDays[0]
+
+    params = dict(season=season, dayOfWeek=dayOfWeek, weekend=weekend,
+                  customDays=customDays, holiday=holiday, timeOfDay=timeOfDay)
+    for (param, description, minval, maxval, periodic, radius,
+         extractor) in _SUB_ENCODER_SPECS:
+      setattr(self, param + "Encoder", None)
+      if params[param] == 0:
+        continue
+
+      if param == "customDays":
+        encoderName = customDayEncoderName
       else:
-        w = timeOfDay
-        radius = 4
-      self.timeOfDayEncoder = ScalarEncoder(w = w, minval=0, maxval=24,
-                              periodic=True, radius=radius, name="time of day")
-      self.timeOfDayOffset = self.width
-      self.width += self.timeOfDayEncoder.getWidth()
-      self.description.append(("time of day", self.timeOfDayOffset))
-      self.encoders.append(("time of day", self.timeOfDayEncoder, self.timeOfDayOffset))
+        encoderName = description
+      if extractor is _getHolidayValue and len(self._holidays) == 1:
+        extractor = _getSingleHolidayValue
+      self._addSubEncoder(param, params[param], description, encoderName,
+                          minval, maxval, periodic, radius, extractor)
+
+    self._initScalarBuffers()
+
+  ############################################################################
+  def __setstate__(self, state):
+    version = state.get("_version", 0)
+    self.__dict__.update(state)
+
+    # Migrate from version 0, which only stored the sub-encoders themselves
+    if version == 0:
+      self._holidays = ((12, 25),)
+      self._holidayCache = {}
+      self._jan1Cache = {}
+
+      self._customDaysMask = 0
+      if hasattr(self, "customDays"):
+        self.customDays = frozenset(self.customDays)
+        for weekday in self.customDays:
+          self._customDaysMask |= 1 << weekday
+
+      # Version 0 sub-encoders have the same descriptions and order as the
+      #  ones built from _SUB_ENCODER_SPECS
+      extractors = dict((spec[1], spec[6]) for spec in _SUB_ENCODER_SPECS)
+      self._extractors = []
+      self._subEncoders = []
+      self._subEncoderOffsets = []
+      for (description, encoder, offset) in self.encoders:
+        extractor = extractors[description]
+        if extractor is _getHolidayValue and len(self._holidays) == 1:
+          extractor = _getSingleHolidayValue
+        self._extractors.append(extractor)
+        self._subEncoders.append(encoder)
+        self._subEncoderOffsets.append(offset)
+      self._initScalarBuffers()
+
+      # Same choice of class as __new__()
+      if type(self) is DateEncoder and self._extractors == \
+          [_getSeasonValue, _getDayOfWeekValue, _getWeekendValue,
+           _getTimeOfDayValue]:
+        self.__class__ = _DateEncoderSDWT
+    elif version != DateEncoder.__VERSION__:
+      raise Exception("Error while deserializing %s: Invalid version %s"
+                      % (self.__class__, version))
+
+    self._version = DateEncoder.__VERSION__
+
+  ############################################################################
+  def _initScalarBuffers(self):
+    """ Allocate the per sub-encoder arrays derived from self._extractors """
+    # Preallocated output of _getScalarBuf(), one slot per sub-encoder
+    self._scalarBuf = numpy.empty(len(self._extractors), dtype=numpy.float64)
+
+    # Field code of each sub-encoder, for _fillBatchScalars()
+    self._fieldCodes = numpy.array([_FIELD_CODES[extractor]
+                                    for extractor in self._extractors],
+                                   dtype=numpy.intc)
+
+  ############################################################################
+  def _addSubEncoder(self, param, value, description, name, minval, maxval,
+                     periodic, radius, extractor):
+    """ Append the sub-encoder for constructor parameter 'param'. 'value' is
+    either its width w, or a (w, radius) tuple that overrides the default
+    radius. """
+    if isinstance(value, (tuple, list)):
+      w, radius = value
+    else:
+      w = value
+
+    encoder = ScalarEncoder(w=w, minval=minval, maxval=maxval, radius=radius,
+                            periodic=periodic, name=name)
+    offset = self.width
+    setattr(self, param + "Encoder", encoder)
+    setattr(self, param + "Offset", offset)
+    self.width += encoder.getWidth()
+    self.description.append((description, offset))
+    self.encoders.append((description, encoder, offset))
+    self._extractors.append(extractor)
+    self._subEncoders.append(encoder)
+    self._subEncoderOffsets.append(offset)
 
   ############################################################################
   def getWidth(self):
@@ -248,73 +508,172 @@ class DateEncoder(Encoder):
   def getEncodedValues(self, input):
     """ See method description in base.py """
 
-    if input == SENTINEL_VALUE_FOR_MISSING_DATA:
+    if input is SENTINEL_VALUE_FOR_MISSING_DATA:
       return numpy.array([None])
 
     assert isinstance(input, datetime.datetime)
-    values = []
 
-    # -------------------------------------------------------------------------
     # Get the scalar values for each sub-field
-    timetuple = input.timetuple()
-    timeOfDay = timetuple.tm_hour + float(timetuple.tm_min)/60.0
+    return [extractor(self, input) for extractor in self._extractors]
+
+  ############################################################################
+  def _getScalarBuf(self, input):
+    """ Fill the preallocated scalar buffer with the scalar value of each
+    sub-field of a (non missing) input and return it. The buffer is reused by
+    the next call, so callers must not hold on to it. """
+    buf = self._scalarBuf
+    i = 0
+    for extractor in self._extractors:
+      buf[i] = extractor(self, input)
+      i += 1
+    return buf
+
+  ############################################################################
+  def getEncodedValuesBatch(self, inputs):
+    """ Vectorized version of getEncodedValues() for many datetimes at once.
+
+    Parameters:
+    -----------------------------------------------------------------------
+    inputs:         A sequence of datetime.datetime objects or a numpy
+                    datetime64 array. Missing values (None / NaT) are allowed.
+
+    Returns:        A float64 numpy array of shape (len(inputs), nFields) where
+                    row i holds the same scalars, in the same order, as
+                    getEncodedValues(inputs[i]). Rows for missing values are
+                    filled with NaN.
+    """
+    arr = numpy.asarray(inputs, dtype='datetime64[us]').ravel()
+    result = numpy.empty((len(arr), len(self.encoders)), dtype=numpy.float64)
+
+    missing = arr.view(numpy.int64) == numpy.iinfo(numpy.int64).min
+    if missing.any():
+      # Give NaT rows a valid placeholder so the field math stays well defined
+      arr = arr.copy()
+      arr[missing] = numpy.datetime64(0, 'us')
+
+    day = arr.astype('datetime64[D]')
 
+    kernel = _getBatchKernel()
+    if kernel is not None:
+      self._fillBatchScalarsJit(kernel, arr, day, result)
+      result[missing] = numpy.nan
+      return result
+
+    # -------------------------------------------------------------------------
+    # Get the scalar values for each sub-field, one column at a time
+    # 1970-01-01 was a Thursday (Monday = 0)
+    dayOfWeek = (day.view(numpy.int64) + 3) % 7
+    minutes = (arr - day).astype(numpy.int64) // 60000000
+    timeOfDay = minutes // 60 + (minutes % 60) / 60.0
+
+    col = 0
     if self.seasonEncoder is not None:
-      dayOfYear = timetuple.tm_yday
-      # input.timetuple() computes the day of year 1 based, so convert to 0 based
-      values.append(dayOfYear-1)
+      year = day.astype('datetime64[Y]').astype('datetime64[D]')
+      result[:, col] = (day - year).astype(numpy.int64)
+      col += 1
 
     if self.dayOfWeekEncoder is not None:
-      dayOfWeek = timetuple.tm_wday #+ timeOfDay / 24.0
-      values.append(dayOfWeek)
+      result[:, col] = dayOfWeek
+      col += 1
 
     if self.weekendEncoder is not None:
       # saturday, sunday or friday evening
-      if timetuple.tm_wday == 6 or timetuple.tm_wday == 5 \
-          or (timetuple.tm_wday == 4 and timeOfDay > 18):
-        weekend = 1
-      else:
-        weekend = 0
-      values.append(weekend)
+      result[:, col] = (dayOfWeek >= 5) | ((dayOfWeek == 4) & (timeOfDay > 18))
+      col += 1
 
     if self.customDaysEncoder is not None:
-      if timetuple.tm_wday in self.customDays:
-        customDay = 1
-      else:
-        customDay = 0
-      values.append(customDay)
-    if self.holidayEncoder is not None:
-      # A "continuous" binary value. = 1 on the holiday itself and smooth ramp
-      #  0->1 on the day before the holiday and 1->0 on the day after the holiday.
-      # Currently the only holiday we know about is December 25
-      # holidays is a list of holidays that occur on a fixed date every year
-      holidays = [(12, 25)]
-      val = 0
-      for h in holidays:
-        # hdate is midnight on the holiday
-        hdate = datetime.datetime(timetuple.tm_year, h[0], h[1], 0, 0, 0)
-        if input > hdate:
-          diff = input - hdate
-          if diff.days == 0:
-            # return 1 on the holiday itself
-            val = 1
-            break
-          elif diff.days == 1:
-            # ramp smoothly from 1 -> 0 on the next day
-            val = 1.0 - (float(diff.seconds) / (86400))
-            break
-        else:
-          diff = hdate - input
-          if diff.days == 0:
-            # ramp smoothly from 0 -> 1 on the previous day
-            val = 1.0 - (float(diff.seconds) / 86400)
+      result[:, col] = numpy.right_shift(self._customDaysMask, dayOfWeek) & 1
+      col += 1
 
-      values.append(val)
+    if self.holidayEncoder is not None:
+      result[:, col] = self._getBatchHolidayValues(
+                                day, (arr - day).view(numpy.int64))
+      col += 1
 
     if self.timeOfDayEncoder is not None:
-      values.append(timeOfDay)
+      result[:, col] = timeOfDay
+      col += 1
+
+    result[missing] = numpy.nan
+    return result
+
+  ############################################################################
+  def _fillBatchScalarsJit(self, kernel, arr, day, result):
+    """ getEncodedValuesBatch() helper: compute all fields at once with
+    'kernel', the numba compiled _fillBatchScalars(). """
+    year = day.astype('datetime64[Y]')
 
-    return values
+    if self.holidayEncoder is not None:
+      holidayDays = self._getBatchHolidayDays(year)
+    else:
+      holidayDays = numpy.empty((len(day), 0), dtype=numpy.int64)
+
+    kernel(day.view(numpy.int64),
+           year.astype('datetime64[D]').view(numpy.int64),
+           (arr - day).view(numpy.int64),
+           holidayDays, self._customDaysMask, self._fieldCodes, result)
+
+  ############################################################################
+  def _getBatchHolidayDays(self, year):
+    """ Return a (len(year), nHolidays) array with the number of days since
+    the epoch of each holiday in each year of a datetime64[Y] array """
+    holidayDays = numpy.empty((len(year), len(self._holidays)),
+                              dtype=numpy.int64)
+    for k, (month, dayOfMonth) in enumerate(self._holidays):
+      hday = (year.astype('datetime64[M]') + (month - 1)) \
+               .astype('datetime64[D]') + (dayOfMonth - 1)
+      holidayDays[:, k] = hday.view(numpy.int64)
+    return holidayDays
+
+  ############################################################################
+  def _getBatchHolidayValues(self, day, micros):
+    """ Vectorized _getHolidayValue() for a datetime64[D] array of days and
+    the matching int64 array of microseconds since midnight """
+    days = day.view(numpy.int64)
+    holidayDays = self._getBatchHolidayDays(day.astype('datetime64[Y]'))
+
+    # Ramp values in whole seconds, like the scalar path
+    after = 1.0 - (micros // 1000000) / 86400.0
+    before = 1.0 - ((86400000000 - micros) // 1000000) / 86400.0
+
+    val = numpy.zeros(len(days))
+    # Records already set by the holiday itself or the day after it. As in
+    #  the scalar loop, those take the first matching holiday.
+    done = numpy.zeros(len(days), dtype=bool)
+    for k in xrange(holidayDays.shape[1]):
+      delta = days - holidayDays[:, k]
+      # ramp smoothly from 0 -> 1 on the previous day
+      val = numpy.where(~done & (delta == -1) & (micros > 0), before, val)
+      # return 1 on the holiday itself
+      val = numpy.where(~done & (delta == 0), 1.0, val)
+      # ramp smoothly from 1 -> 0 on the next day
+      val = numpy.where(~done & (delta == 1), after, val)
+      done |= (delta == 0) | (delta == 1)
+    return val
+
+  ############################################################################
+  def encodeManyIntoArray(self, inputs, output):
+    """ Encode a sequence of datetimes into the rows of a 2D output array.
+
+    Equivalent to calling encodeIntoArray(inputs[i], output[i]) for each i, but
+    the scalars for all inputs are computed in one pass by
+    getEncodedValuesBatch().
+    """
+    scalars = self.getEncodedValuesBatch(inputs)
+    assert output.shape[0] == scalars.shape[0]
+
+    missing = numpy.isnan(scalars).any(axis=1).tolist()
+
+    # The sub-encoders only use the scalars one at a time, so hand them plain
+    #  Python floats, which are cheaper to do arithmetic on than numpy scalars
+    offsets = self._subEncoderOffsets
+    for row, rowScalars, isMissing in zip(output, scalars.tolist(), missing):
+      if isMissing:
+        row[0:] = 0
+        continue
+
+      for i, encoder in enumerate(self._subEncoders):
+        encoder.encodeIntoArray(rowScalars[i], row[offsets[i]:])
 
   ############################################################################
   def getScalars(self, input):
@@ -332,13 +691,15 @@ class DateEncoder(Encoder):
                     Note: some of these fields might be omitted if they were not
                     specified in the encoder
     """
+    # Not built from the float64 scalar buffer, so that the dtype is the one
+    #  numpy infers from the values, e.g. integers for dayOfWeek only
     return numpy.array(self.getEncodedValues(input))
 
   ############################################################################
   def getBucketIndices(self, input):
     """ See method description in base.py """
 
-    if input == SENTINEL_VALUE_FOR_MISSING_DATA:
+    if input is SENTINEL_VALUE_FOR_MISSING_DATA:
       # Encoder each sub-field
       return [None] * len(self.encoders)
 
@@ -346,12 +707,11 @@ class DateEncoder(Encoder):
       assert isinstance(input, datetime.datetime)
 
       # Get the scalar values for each sub-field
-      scalars = self.getScalars(input)
+      scalars = self._getScalarBuf(input)
 
       # Encoder each sub-field
       result = []
-      for i in xrange(len(self.encoders)):
-        (name, encoder, offset) = self.encoders[i]
+      for i, encoder in enumerate(self._subEncoders):
         result.extend(encoder.getBucketIndices(scalars[i]))
       return result
 
@@ -359,19 +719,62 @@ class DateEncoder(Encoder):
   def encodeIntoArray(self, input, output):
     """ See method description in base.py """
 
-    if input == SENTINEL_VALUE_FOR_MISSING_DATA:
+    if input is SENTINEL_VALUE_FOR_MISSING_DATA:
       output[0:] = 0
     else:
       assert isinstance(input, datetime.datetime)
 
       # Get the scalar values for each sub-field
-      scalars = self.getScalars(input)
+      scalars = self._getScalarBuf(input)
 
       # Encoder each sub-field
-      for i in xrange(len(self.encoders)):
-        (name, encoder, offset) = self.encoders[i]
-        encoder.encodeIntoArray(scalars[i], output[offset:])
+      offsets = self._subEncoderOffsets
+      for i, encoder in enumerate(self._subEncoders):
+        encoder.encodeIntoArray(scalars[i], output[offsets[i]:])
+
+  ############################################################################
+  def encodeIntoArrayFromEpoch(self, timestamp, output):
+    """ Same as encodeIntoArray(), but the input is a Unix timestamp (seconds
+    since 1970-01-01 00:00 UTC, int or float) instead of a datetime. The
+    encoding is that of the corresponding UTC time, i.e. of
+    datetime.datetime.utcfromtimestamp(timestamp).
+    """
 
+    if timestamp is SENTINEL_VALUE_FOR_MISSING_DATA:
+      output[0:] = 0
+    else:
+      try:
+        input = datetime.datetime.utcfromtimestamp(timestamp)
+      except ValueError:
+        # Out of range for the platform, e.g. negative timestamps on Windows
+        input = _EPOCH + datetime.timedelta(seconds=timestamp)
+      self.encodeIntoArray(input, output)
+
+  ############################################################################
+  def encodeAndGetBucketIndices(self, input, output):
+    """ Same as calling encodeIntoArray(input, output) followed by
+    getBucketIndices(input), but computes the sub-field scalars only once.
+
+    Returns:        The bucket indices, as returned by getBucketIndices()
+    """
+
+    if input is SENTINEL_VALUE_FOR_MISSING_DATA:
+      output[0:] = 0
+      return [None] * len(self.encoders)
+
+    else:
+      assert isinstance(input, datetime.datetime)
+
+      # Get the scalar values for each sub-field
+      scalars = self._getScalarBuf(input)
+
+      # Encoder each sub-field
+      result = []
+      offsets = self._subEncoderOffsets
+      for i, encoder in enumerate(self._subEncoders):
+        encoder.encodeIntoArray(scalars[i], output[offsets[i]:])
+        result.extend(encoder.getBucketIndices(scalars[i]))
+      return result
 
   ############################################################################
   def getDescription(self):
@@ -379,6 +782,45 @@ class DateEncoder(Encoder):
 
 
 
+############################################################################
+class _DateEncoderSDWT(DateEncoder):
+  """ DateEncoder with exactly the season, dayOfWeek, weekend and timeOfDay
+  sub-encoders, in that order. The scalar extraction is inlined instead of
+  going through the list of extractors. Created by DateEncoder.__new__(), do
+  not instantiate directly.
+  """
+
+  ############################################################################
+  def _getValues(self, input):
+    """ Return the (season, dayOfWeek, weekend, timeOfDay) scalars of a (non
+    missing) input """
+    dayOfWeek = input.weekday()
+    timeOfDay = input.hour + input.minute / 60.0
+    # saturday, sunday or friday evening
+    if dayOfWeek >= 5 or (dayOfWeek == 4 and timeOfDay > 18):
+      weekend = 1
+    else:
+      weekend = 0
+    return (_getSeasonValue(self, input), dayOfWeek, weekend, timeOfDay)
+
+  ############################################################################
+  def getEncodedValues(self, input):
+    """ See method description in base.py """
+
+    if input is SENTINEL_VALUE_FOR_MISSING_DATA:
+      return numpy.array([None])
+
+    assert isinstance(input, datetime.datetime)
+    return list(self._getValues(input))
+
+  ############################################################################
+  def _getScalarBuf(self, input):
+    """ See DateEncoder._getScalarBuf() """
+    buf = self._scalarBuf
+    buf[0], buf[1], buf[2], buf[3] = self._getValues(input)
+    return buf
+
+
 
 ############################################################################
 def testDateEncoder():
@@ -387,6 +829,7 @@ def testDateEncoder():
 
   # 3 bits for season, 1 bit for day of week, 2 for weekend, 5 for time of day
   e = DateEncoder(season=3, dayOfWeek=1, weekend=3, timeOfDay=5)
+  assert type(e) is _DateEncoderSDWT
   assert e.getDescription() == [("season", 0), ("day of week", 12),
                                 ("weekend", 19), ("time of day", 25)]
 
@@ -481,6 +924,15 @@ def testDateEncoder():
   d = datetime.datetime(2011, 12, 24, 16, 00)
   assert (e.encode(d) == holiday2).all()
 
+  # Midnight on the holiday ends the ramp of the previous day, as a float
+  d = datetime.datetime(2010, 12, 25)
+  assert (e.encode(d) == holiday).all()
+  assert type(e.getEncodedValues(d)[0]) is float
+
+  # The ramp is exactly 0.1 here, which must stay in the lowest bucket
+  d = datetime.datetime(2010, 12, 24, 2, 24)
+  assert (e.encode(d) == notholiday).all()
+
   # Test weekend encoder
   e = DateEncoder(customDays = (21,["sat","sun","fri"]))
   mon = DateEncoder(customDays = (21,"Monday"))
@@ -497,6 +949,111 @@ def testDateEncoder():
        assert d.weekday()==0
     else:
        assert not (d.weekday()==0)
+
+  # getScalars() keeps integer scalars as integers
+  d = datetime.datetime(2010, 11, 4, 14, 55)
+  assert DateEncoder(dayOfWeek=3).getScalars(d).dtype.kind == 'i'
+  assert DateEncoder(weekend=3, customDays=(3, "mon")).getScalars(d).dtype.kind \
+         == 'i'
+
+  # Batch encoding must match encoding one datetime at a time
+  e = DateEncoder(season=3, dayOfWeek=1, weekend=3, holiday=5, timeOfDay=5,
+                  customDays=(3, ["mon", "wed"]))
+  dates = [datetime.datetime(2010, 11, 4, 14, 55),
+           datetime.datetime(2010, 12, 25, 4, 55),
+           datetime.datetime(1999, 12, 26, 8, 00),
+           datetime.datetime(2011, 12, 24, 16, 00),
+           datetime.datetime(1969, 7, 20, 20, 17),
+           SENTINEL_VALUE_FOR_MISSING_DATA]
+  scalars = e.getEncodedValuesBatch(dates)
+  assert scalars.shape == (len(dates), len(e.encoders))
+  for d, row in zip(dates[:-1], scalars):
+    assert numpy.allclose(row, e.getScalars(d))
+  assert numpy.isnan(scalars[-1]).all()
+
+  # The batch kernel is only compiled when numba is installed; run it
+  #  uncompiled so its rules are checked against the scalar extractors too
+  kernelDates = dates[:-1] + [datetime.datetime(2010, 12, 24, 2, 24),
+                              datetime.datetime(2010, 12, 26, 21, 36),
+                              datetime.datetime(2004, 12, 24, 0, 0, 0, 1),
+                              datetime.datetime(2004, 12, 26, 23, 59, 59),
+                              datetime.datetime(2013, 5, 10, 18, 1)]
+  arr = numpy.asarray(kernelDates, dtype='datetime64[us]')
+  scalars = numpy.empty((len(arr), len(e.encoders)), dtype=numpy.float64)
+  e._fillBatchScalarsJit(_fillBatchScalars, arr, arr.astype('datetime64[D]'),
+                         scalars)
+  for d, row in zip(kernelDates, scalars):
+    assert row.tolist() == e.getEncodedValues(d)
+
+  output = numpy.ones((len(dates), e.getWidth()), dtype=defaultDtype)
+  e.encodeManyIntoArray(dates, output)
+  for d, row in zip(dates, output):
+    assert (row == e.encode(d)).all()
+
+  # Encoding from a Unix timestamp must match encoding the UTC datetime,
+  #  including outside of the precomputed range of years
+  for timestamp in [1288882500, 1293252900.5, 946195200, 1324742400 - 0.25,
+                    -14182980, 7289654400]:
+    output = numpy.ones(e.getWidth(), dtype=defaultDtype)
+    e.encodeIntoArrayFromEpoch(timestamp, output)
+    d = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=timestamp)
+    assert (output == e.encode(d)).all()
+
+  # The specialized season/dayOfWeek/weekend/timeOfDay encoder must match the
+  #  generic one
+  e1 = DateEncoder(season=3, dayOfWeek=1, weekend=3, timeOfDay=5)
+  e2 = object.__new__(DateEncoder)
+  e2.__init__(season=3, dayOfWeek=1, weekend=3, timeOfDay=5)
+  for d in dates[:-1]:
+    v1 = e1.getEncodedValues(d)
+    v2 = e2.getEncodedValues(d)
+    assert [type(v) for v in v1] == [type(v) for v in v2]
+    assert v1 == v2
+    assert (e1.encode(d) == e2.encode(d)).all()
+
+  # Encoders pickled before the scalar extractors and the state derived from
+  #  the sub-encoders were kept on the encoder must still load and encode
+  import cPickle as pickle
+  for e1 in [e, DateEncoder(season=3, dayOfWeek=1, weekend=3, timeOfDay=5)]:
+    state = dict((k, v) for (k, v) in e1.__dict__.iteritems()
+                 if k in ("width", "description", "name", "encoders")
+                 or k.endswith("Encoder") or k.endswith("Offset"))
+    if hasattr(e1, "customDays"):
+      state["customDays"] = sorted(e1.customDays)
+    old = object.__new__(DateEncoder)
+    old.__dict__.update(state)
+    for protocol in (0, 2):
+      e2 = pickle.loads(pickle.dumps(old, protocol))
+      assert type(e2) is type(e1)
+      for d in dates:
+        output = numpy.ones(e2.getWidth(), dtype=defaultDtype)
+        e2.encodeIntoArray(d, output)
+        assert (output == e1.encode(d)).all()
+        assert e2.getBucketIndices(d) == e1.getBucketIndices(d)
+      assert (e2.encode(datetime.datetime(2010, 12, 24, 2, 24)) ==
+              e1.encode(datetime.datetime(2010, 12, 24, 2, 24))).all()
+      e3 = pickle.loads(pickle.dumps(e2, protocol))
+      assert type(e3) is type(e1)
+      assert e3.getBucketIndices(dates[0]) == e1.getBucketIndices(dates[0])
+
+  # Minutes are converted to hours with an exact division; at a 1 minute
+  #  resolution a multiplication by 1/60 moves some minutes to another bucket
+  e1 = DateEncoder(season=(1, 1), dayOfWeek=(1, 1), timeOfDay=(1, 1.0/60),
+                   weekend=1, holiday=1)
+  minuteDates = [datetime.datetime(2010, 11, 4) + datetime.timedelta(minutes=m)
+                 for m in xrange(24 * 60)]
+  batch = e1.getEncodedValuesBatch(minuteDates)
+  for d, row in zip(minuteDates, batch):
+    timeOfDay = d.hour + d.minute / 60.0
+    assert e1.getScalars(d)[-1] == timeOfDay and row[-1] == timeOfDay
+    assert e1.getBucketIndices(d)[-1] == \
+           e1.timeOfDayEncoder.getBucketIndices(timeOfDay)[0]
+
+  # Fused encoding + bucket indices must match the separate calls
+  for d in dates:
+    output = numpy.ones(e.getWidth(), dtype=defaultDtype)
+    assert e.encodeAndGetBucketIndices(d, output) == e.getBucketIndices(d)
+    assert (output == e.encode(d)).all()
   print "passed"
 
 ################################################################################